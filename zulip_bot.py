@@ -14,58 +14,55 @@ bot.
 """
 
 import os
-import re
+import io
+import atexit
 import sys
 import logging
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
 import datetime
 import time
+import threading
+from queue import Queue
 import sqlite3
 from sqlite3 import Error, Connection
-from json import load
-from typing import Any, Union, List, IO, Text, Dict, Optional, Tuple
-from dateutil import tz
-from dateutil.relativedelta import relativedelta
+# orjson is optional: it parses the users mapping faster than the standard library
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Union, List, IO, Text, Dict, Optional, Tuple
+from zoneinfo import ZoneInfo
 from configparser import ConfigParser, ExtendedInterpolation
 from argparse import ArgumentParser
 
-from telegram import Update, ForceReply, File, Message, MessageEntity
+from telegram import Bot, Update, ForceReply, Message, MessageEntity
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext
 
 import zulip
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 ###########
 #  Utils  #
 ###########
 
-# Log an event and save it in a file with current date as name if enabled
-def log(severity, msg):
-    """A wrapper logging function"""
+# Log an event. If enabled, the logger also saves it in a file rotated every midnight
+def log(severity, msg, *args):
+    """A wrapper logging function. 'msg' is formatted with 'args' only if the message is actually logged"""
     # Check if logging is enabled
-    if log_level == 0:
+    if log_level == 0 or not logger.isEnabledFor(severity):
         return
 
-    # Add file handler to logger if enabled
-    # TODO: this if-block can be removed. Logging to disk is managed by supervisor
-    if config["log"].getboolean("log_to_file"):
-        now = datetime.datetime.now(tz=local_tz).strftime(date_format)
-
-        # If current date not the same as initial one, create new FileHandler
-        if str(now) != str(date):
-            # Remove old handlers
-            for hdlr in logger.handlers[:]:
-                logger.removeHandler(hdlr)
-
-            new_hdlr = logging.FileHandler(logfile_path, encoding="utf-8")
-            new_hdlr.setLevel(log_level)
-
-            # Format file handler
-            new_hdlr.setFormatter(formatter)
-
-            # Add file handler to logger
-            logger.addHandler(new_hdlr)
-
     # The actual logging
-    logger.log(severity, msg)
+    logger.log(severity, msg, *args)
+
+@lru_cache(maxsize=8)
+def day_topic(day: int) -> Text:
+    """Return the topic for the day with the given proleptic Gregorian ordinal, i.e., its formatted date"""
+    return datetime.date.fromordinal(day).strftime(date_fmt)
 
 def int_time(timestamp: datetime.datetime) -> int:
     """Return an integer timesteamp from a datetime object"""
@@ -77,79 +74,231 @@ def int_time(timestamp: datetime.datetime) -> int:
 
 def zulip_api_request(stream: Text,
                 topic: Union[Text, datetime.datetime],
-                content: List[Message],
+                message: Message,
+                original: Optional[Message] = None,
                 is_edit: Optional[bool] = False,
-                attachment_url: Optional[Text] = None,
+                attachment: Optional[Future] = None,
                 mentions: Optional[List] = None) -> None:
-    """Process a message update from Telegram and construct the request to send to Zulip via the API"""
+    """
+    Process a message update from Telegram and construct the request to send to Zulip via the API.
+    'attachment' resolves to the URL of the attached file: it's waited for only when the request is sent
+    """
 
     # Message properties
-    date = content[0].date.astimezone(local_tz)
-    message_id = content[0].message_id
-    chat_id = content[0].chat.id
-    sender_name = content[0].from_user.first_name
+    date = message.date.astimezone(local_tz)
+    message_id = message.message_id
+    chat_id = message.chat.id
+    sender_name = message.from_user.first_name
     message_link = message_link_fmt.format(str(chat_id)[4:], message_id)
 
-    # Request template
-    text = ""
-    request = {
-        "type": "stream",
-        "to": stream,
-        "topic": date.strftime(date_fmt) if date_as_topic else topic,
-        "content": ""
-    }
-
-    # If there are mentions, they should be prepended to the message text
-    if mentions:
-        mentioned_users = " ".join(mentions)
-        text += f"{mentioned_users} "
-
-    # Check if content represents a message with a reply
-    if None in content:
-        # content is a new message
-        if content[0].caption:
-            text += content[0].caption
-        elif content[0].text:
-            text += content[0].text
+    # The message's text, prepended by the mentions if there are any
+    text = " ".join(mentions) + " " if mentions else ""
+    text += message.caption or message.text or ""
 
-        request['content'] += f"*[{sender_name}]({message_link}):*\n{text}"
+    # The content of the request is built in parts, joined at the end
+    parts = []
 
-    else:
-        # content = reply message + original message
+    # Check if the message is a reply to an original message
+    if original is not None:
+        # a reply message + the original message, which is quoted first
         # Check if original message and reply have the same date. If not, include the date in the quoted reply
-        reply_date = content[1].date.astimezone(local_tz)
-        reply_date_print = reply_date.strftime(time_fmt) if (reply_date.strftime(date_fmt) == date.strftime(date_fmt)) else reply_date.strftime(f"{date_fmt}, {time_fmt}")
+        reply_date = original.date.astimezone(local_tz)
+        reply_date_print = reply_date.strftime(time_fmt if reply_date.date() == date.date() else datetime_fmt)
+
+        original_text = original.caption or original.text or ""
 
-        reply_text, original_text = [x if x is not None else "" for x in [c.caption if c.caption else c.text for c in content]]
-        text += reply_text
+        parts.append(f"> *{original.from_user.first_name} wrote ({reply_date_print}):*\n> {original_text}\n\n")
 
-        request['content'] += f"> *{content[1].from_user.first_name} wrote ({reply_date_print}):*\n> {original_text}\n\n*[{sender_name}]({message_link}):*\n{text}"
+    parts.append(f"*[{sender_name}]({message_link}):*\n{text}")
 
-    # Append a link to the attached file to the message being forwarded
-    if attachment_url is not None:
-        request['content'] += f"\n[Link to file]({attachment_url})"
+    request = {
+        "type": "stream",
+        "to": stream,
+        "topic": day_topic(date.toordinal()) if date_as_topic else topic,
+        "content": "".join(parts)
+    }
 
-    # Submit the request and check the response JSON
+    # Submit the request. It's sent by the Zulip pool, so the handler doesn't wait for Zulip's response
     if not is_edit:
-        result = zulip_client.send_message(request)
-        if check_response(result):
-            db_add_id(message_id, result['id'], int_time(date))
+        if batch_window > 0:
+            queue_message(chat_id, request, message_id, int_time(date), attachment)
+        else:
+            submit_request(chat_id, send_message, request, message_id, int_time(date), attachment)
     else:
-        if (date + _60min_delta) >= datetime.datetime.now().astimezone(local_tz):
-            check_response(
-                zulip_client.update_message({
-                "message_id": db_find_id(message_id)[0],
-                "content": request['content']
-                })
-            )
+        if (date + _60min_delta) >= datetime.datetime.now(tz=local_tz):
+            submit_request(chat_id, update_message, request['content'], message_id, attachment)
         else:
-            log(logging.WARNING, f"User {sender_name} tried to edit a message older than 60 minutes. Zulip doesn't allow such edits.")
-            log(logging.WARNING, f"Removing Telegram message with id {message_id} from the database.")
+            log(logging.WARNING, "User %s tried to edit a message older than 60 minutes. Zulip doesn't allow such edits.", sender_name)
+            log(logging.WARNING, "Removing Telegram message with id %s from the database.", message_id)
             db_remove_id(message_id)
+            with zulip_chats_lock:
+                zulip_merged.pop(message_id, None)
+
+def submit_request(chat_id: int, func: Callable, *args: Any, after: Optional[Future] = None) -> None:
+    """
+    Queue a call to the Zulip API in the Zulip pool.
+    The calls for the same chat are chained, so that they reach Zulip in the same order as the messages.
+    If 'after' is given, the call also waits for it to be done, without holding a worker of the pool
+    """
+    with zulip_chats_lock:
+        previous = zulip_chats.get(chat_id)
+        done = Future()
+        zulip_chats[chat_id] = done
+
+    def run() -> None:
+        try:
+            func(*args)
+        except Exception as e:
+            log(logging.ERROR, "Zulip API request failed: %s", e)
+        finally:
+            with zulip_chats_lock:
+                if zulip_chats.get(chat_id) is done:
+                    del zulip_chats[chat_id]
+            done.set_result(None)
+
+    def start(_: Optional[Future] = None) -> None:
+        if after is None:
+            zulip_pool.submit(run)
+        else:
+            after.add_done_callback(lambda _: zulip_pool.submit(run))
+
+    if previous is None:
+        start()
+    else:
+        previous.add_done_callback(start)
+
+def wait_requests() -> None:
+    """Wait until all the queued requests to Zulip have been sent. Must be called before the interpreter exits"""
+    while True:
+        with zulip_chats_lock:
+            pending = list(zulip_chats.values())
+        if not pending:
+            return
+        wait(pending)
+
+def attach_file(content: Text, attachment: Optional[Future]) -> Text:
+    """Append a link to the attached file, if any, to the content of a message"""
+    if attachment is None:
+        return content
+    try:
+        attachment_url = attachment.result()
+    except Exception as e:
+        log(logging.ERROR, "Cannot get the attached file: %s. Forwarding the message without it", e)
+        return content
+    if attachment_url is None:
+        return content
+    return f"{content}\n[Link to file]({attachment_url})"
+
+def send_message(request: Dict, message_id: int, timestamp: int, attachment: Optional[Future] = None) -> None:
+    """Send a new message to Zulip and store its id"""
+    request['content'] = attach_file(request['content'], attachment)
+    result = zulip_client.send_message(request)
+    if check_response(result):
+        db_add_id(message_id, result['id'], timestamp)
+
+def update_message(content: Text, message_id: int, attachment: Optional[Future] = None) -> None:
+    """Edit the content of a message already sent to Zulip"""
+    content = attach_file(content, attachment)
+    with zulip_chats_lock:
+        merged = zulip_merged.get(message_id)
+    if merged is not None:
+        # The message was merged with others: only its own part of the Zulip message changes
+        zulip_msg_id, parts = merged
+        parts[message_id] = content
+        content = batch_separator.join(parts.values())
+    else:
+        found = db_find_id(message_id)
+        if found is None:
+            log(logging.WARNING, "Telegram message with id %s was never forwarded to Zulip. Cannot edit it.", message_id)
+            return
+        zulip_msg_id, was_merged = found
+        if was_merged:
+            # The other parts of the Zulip message are lost (restart or eviction): editing it would drop them
+            log(logging.WARNING, "Telegram message with id %s is part of a merged Zulip message that can no longer be edited.", message_id)
+            return
+    check_response(
+        zulip_client.update_message({
+        "message_id": zulip_msg_id,
+        "content": content
+        })
+    )
+
+def queue_message(chat_id: int, request: Dict, message_id: int, timestamp: int, attachment: Optional[Future] = None) -> None:
+    """
+    Add a new message to the chat's open batch, or open a new batch if there is none or it's too long.
+    A batch is sent 'batch_window' seconds after it has been opened, or later if the chat's previous requests are slow
+    """
+    item = (request, message_id, timestamp, attachment)
+    with zulip_chats_lock:
+        batch = zulip_batches.get(chat_id)
+        if batch is not None:
+            length = sum(len(queued[0]['content']) + len(batch_separator) for queued in batch)
+            if length + len(request['content']) <= batch_max_length:
+                batch.append(item)
+                return
+        # A batch too long is closed: it will be sent as it is
+        batch = [item]
+        zulip_batches[chat_id] = batch
+    # The batch is chained now, to keep its place in the chat's requests, but it waits for the window with a timer
+    window = Future()
+    threading.Timer(batch_window, window.set_result, (None,)).start()
+    submit_request(chat_id, send_batch, chat_id, batch, after=window)
+
+def send_batch(chat_id: int, batch: List) -> None:
+    """Send a batch of new messages, merging the consecutive messages for the same topic into one"""
+    # Close the batch: the next messages will open a new one
+    with zulip_chats_lock:
+        if zulip_batches.get(chat_id) is batch:
+            del zulip_batches[chat_id]
+
+    # Group the consecutive messages for the same topic, as long as the merged message is not too long
+    # The links to the attached files make the messages longer than when they were queued
+    groups = []
+    for request, message_id, timestamp, attachment in batch:
+        request['content'] = attach_file(request['content'], attachment)
+        item = (request, message_id, timestamp)
+        length = len(request['content'])
+        if groups:
+            group, group_length = groups[-1]
+            if group[-1][0]['topic'] == request['topic'] and group_length + len(batch_separator) + length <= batch_max_length:
+                group.append(item)
+                groups[-1] = (group, group_length + len(batch_separator) + length)
+                continue
+        groups.append(([item], length))
+
+    for group, _ in groups:
+        if len(group) == 1:
+            send_message(*group[0])
+            continue
+        parts = {message_id: request['content'] for request, message_id, _ in group}
+        try:
+            result = zulip_client.send_message(dict(group[0][0], content=batch_separator.join(parts.values())))
+            sent = check_response(result)
+        except Exception as e:
+            log(logging.ERROR, "Cannot send %d merged messages to Zulip: %s", len(group), e)
+            sent = False
+        if not sent:
+            # Don't lose the messages: send them one by one
+            log(logging.WARNING, "Sending %d messages to Zulip one by one", len(group))
+            for item in group:
+                try:
+                    send_message(*item)
+                except Exception as e:
+                    log(logging.ERROR, "Cannot send Telegram message with id %s to Zulip: %s", item[1], e)
+            continue
+        # The parts of the merged message are only kept in memory: editing one of them needs all of them.
+        # The database only records that the messages were merged, to tell why they can't be edited anymore
+        for _, message_id, timestamp in group:
+            db_add_id(message_id, result['id'], timestamp, merged=True)
+        with zulip_chats_lock:
+            for message_id in parts:
+                zulip_merged[message_id] = (result['id'], parts)
+            while len(zulip_merged) > db_cache_size:
+                zulip_merged.popitem(last=False)
 
 def check_response(result: Dict) -> bool:
     if result['result'] != 'success':
-        log(logging.ERROR, f"Zulip API returned '{result['code']}': {result['msg']}")
+        log(logging.ERROR, "Zulip API returned '%s': %s", result.get('code', result['result']), result.get('msg'))
         return False
     return True
 
@@ -160,6 +309,28 @@ def check_response(result: Dict) -> bool:
 # Message link format, to be able to link back a message from Zulip to Telegram
 message_link_fmt = "https://t.me/c/{}/{}"
 
+# Supported contents of a message besides text, and how to get the id of their file
+# A photo is available in several sizes: the last one is the largest
+content_file_ids = {
+    'photo': lambda photo: photo[-1].file_id,
+    'document': lambda document: document.file_id,
+    'video': lambda video: video.file_id,
+    'video_note': lambda video_note: video_note.file_id,
+    'audio': lambda audio: audio.file_id,
+    'voice': lambda voice: voice.file_id,
+}
+# Only the messages with a supported content reach 'process_message'
+supported_content = Filters.text | Filters.photo | Filters.document | Filters.video | Filters.video_note | Filters.audio | Filters.voice
+
+# Requests of files' URLs (and uploads) to Telegram, run while the message waits in its chat's chain.
+# A separate pool: a Zulip job waiting for a file queued behind other waiting Zulip jobs could block them all
+telegram_files_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="telegram_files")
+
+# URLs of the files uploaded to Zulip, by Telegram's file_id (LRU cache)
+uploads_cache = OrderedDict()
+uploads_cache_size = 1024
+uploads_lock = threading.Lock()
+
 # Define a few command handlers. These usually take the two arguments update and
 # context.
 def start(update: Update, _: CallbackContext) -> None:
@@ -174,132 +345,204 @@ def help_command(update: Update, _: CallbackContext) -> None:
     """Send a message when the command /help is issued."""
     update.message.reply_text('At the moment, you cannot interact with me. I am only listening to your discussions 👀...')
 
-def download_file(file: File) -> Text:
-    """Request the download of a file"""
-    file_path = os.path.join(downloads_dir, file.file_unique_id)
-    with open(file_path, 'wb') as out:
-        file.download(custom_path=None, out=out)
-    return file_path
+def get_attachment_url(bot: Bot, file_id: Text) -> Optional[Text]:
+    """
+    Return the URL of an attached file: Telegram's URL, or, if 'upload_files' is enabled, the URL of a copy
+    uploaded to Zulip. The file is downloaded in memory, never written to disk.
+    If the upload fails, return None: Telegram's URL would expose the bot's token
+    """
+    with uploads_lock:
+        uri = uploads_cache.get(file_id)
+    if uri is not None:
+        # An edited message still has the same file: don't upload it again
+        return uri
+
+    file = bot.get_file(file_id)
+    if not upload_files:
+        return file.file_path
+
+    out = io.BytesIO(file.download_as_bytearray())
+    out.name = os.path.basename(file.file_path)
+    result = zulip_client.upload_file(out)
+    if not check_response(result):
+        log(logging.ERROR, "Cannot upload file %s to Zulip. Forwarding the message without it", out.name)
+        return None
+
+    with uploads_lock:
+        uploads_cache[file_id] = result['uri']
+        if len(uploads_cache) > uploads_cache_size:
+            uploads_cache.popitem(last=False)
+    return result['uri']
+
+def unsupported_content(update: Update, _: CallbackContext) -> None:
+    """Tell the user that a message can't be forwarded"""
+    message = update.effective_message
+    user = message.from_user
+    log(logging.WARNING, "User %s sent a message with an unsupported content", user)
+    text = f"Sorry {user.first_name}, I cannot forward a message with this content to Zulip 😞"
+    message.reply_text(text=text, quote=True, disable_notification=True)
 
 def process_message(update: Update, context: CallbackContext) -> None:
     """
     Process an update message: text-only or with a media (photo, video, document, audio, voice message)
     """
     message = update.effective_message # 'effective_message' represents both new and edited messages
-    user = message.from_user
 
     # Is the update an edit of a previous message?
-    is_edit = True if update.edited_message else False
+    is_edit = update.edited_message is not None
+
+    # Is the message a reply? If not, 'reply_to_message' is None
+    original_msg = message.reply_to_message
+
+    # Only one of text and caption is set
+    text, caption = message.text, message.caption
+
+    # If the message is not text-only, it has some content: photo, generic file, video, or audio are supported
+    file_id = None
+    if not text:
+        for content_type, get_file_id in content_file_ids.items():
+            content = getattr(message, content_type)
+            if content:
+                file_id = get_file_id(content)
+                break
 
-    # Is the message a reply?
-    # FIXME: this syntax is not very elegant. There must be a better way to write it!
-    original_msg = message.reply_to_message if message.reply_to_message else None
+    # Request the file's URL (or upload the file) now: the Zulip pool waits for it only when the message is sent
+    attachment = telegram_files_pool.submit(get_attachment_url, context.bot, file_id) if file_id is not None else None
 
     # Does the message or caption contain a @mention (or more than one)?
     mentioned_users = []
     if not users_mapping:
         log(logging.WARNING, "Cannot forward message/caption @-mentions without a users mapping file. Check your config.")
     else:
-        entities = message.caption_entities if message.caption_entities else message.entities
+        entities = message.caption_entities if caption else message.entities
         if entities:
+            # Each entity knows its position in the text (or caption)
+            parse_entity = message.parse_caption_entity if caption else message.parse_entity
             for entity in entities:
-                if entity.type == 'text_mention':
-                    # This is a full-name (or first name) mention
-                    mentioned_users.append(f"@_**{users_mapping[entity.user.first_name]}**")
-                elif entity.type == 'mention':
+                entity_type = entity.type
+                if entity_type == 'text_mention':
+                    # This is a full-name (or first name) mention. Prefer the user's id, which is unique, to the first name
+                    entity_user = entity.user
+                    _user = entity_user.id if entity_user.id in users_mapping else entity_user.first_name
+                elif entity_type == 'mention':
                     # If a user has set a @username, the entity doesn't bear a telegram.User object
-                    # Use a regex to find any @-mention which will be present verbatin in message's text
-                    _text = message.caption if message.caption else message.text
-                    match = re.search(r'@([\w\d]+)', _text)
-                    if match:
-                        _user = match.group(1)
-                        if _user in users_mapping:
-                            mentioned_users.append(f"@_**{users_mapping[_user]}**")
-
-    if message.text:
-        # text-only message
-        zulip_api_request(
-            stream = stream,
-            topic = topic,
-            content = [message, original_msg],
-            is_edit = is_edit,
-            attachment_url = None,
-            mentions = mentioned_users)
-
-    else:
-        # the message has some content: photo, generic file, video, or audio are supported
-        if message.photo:
-            file_id = message.photo[-1].file_id
-        elif message.document:
-            file_id = message.document.file_id
-        elif message.video:
-            file_id = message.video.file_id
-        elif message.video_note:
-            file_id = message.video_note.file_id
-        elif message.audio:
-            file_id = message.audio.file_id
-        elif message.voice:
-            file_id = message.voice.file_id
-        else:
-            file_id = None
-            log(logging.WARNING, f"User {user} sent a message with an unsupported content")
-            text = f"Sorry {user.first_name}, I cannot forward a message with this content to Zulip 😞"
-            message.reply_text(text=text, quote=True, disable_notification=True)
-        
-        # Download the file and build a request with the file attached
-        if file_id is not None:
-            file_path = (context.bot.get_file(file_id)).file_path 
-            zulip_api_request(
-                stream = stream,
-                topic = topic,
-                content = [message, original_msg],
-                is_edit = is_edit,
-                attachment_url = file_path,
-                mentions = mentioned_users)
+                    # Its text is the @username itself
+                    _user = parse_entity(entity).lstrip('@')
+                else:
+                    continue
+                if _user in users_mapping:
+                    mentioned_users.append(f"@_**{users_mapping[_user]}**")
+
+    # Build a request with a link to the attached file, if any
+    zulip_api_request(
+        stream = stream,
+        topic = topic,
+        message = message,
+        original = original_msg,
+        is_edit = is_edit,
+        attachment = attachment,
+        mentions = mentioned_users)
 
 ####################
 #  Database utils  #
 ####################
 
-def db_connect():
-    connection = None
-    db_path = os.path.abspath(config['db'].get('db_path', 'data.db'))
+# Statements on the hot path. sqlite3 caches the prepared statements, keyed by the query string
+db_insert_query = "INSERT OR IGNORE INTO messages (tid, zid, timestamp, merged) VALUES (?, ?, ?, ?)"
+db_find_query = "SELECT zid, merged FROM messages WHERE tid=?"
+
+def db_connect() -> Connection:
+    """Open the connection shared by all the database queries and tune it for frequent small writes"""
     try:
-        connection = sqlite3.connect(db_path)
+        connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, cached_statements=256)
     except Error as e:
-        log(logging.ERROR, f"SQLite3: error {e} occurred")
+        log(logging.ERROR, "SQLite3: error %s occurred", e)
+        raise
+    for pragma in db_pragmas:
+        connection.execute(pragma)
     return connection
 
 def db_run_query(query: Text, *params: Tuple, read: bool = False):
-    connect = db_connect()
-    cursor = connect.cursor()
-    try:
-        cursor.execute(query, params)
-        cursor.connection.commit()
+    # The connection is in autocommit mode and shared between the dispatcher's threads
+    with db_lock:
+        cursor = db_connection.execute(query, params)
         if read:
             return cursor.fetchone()
-    except:
-        cursor.connection.rollback()
-        raise
-    finally:
-        cursor.close()
-        #connect.close()
 
 def db_create():
-    query = "CREATE TABLE IF NOT EXISTS messages (tid INTEGER PRIMARY KEY, zid INTEGER, timestamp INTEGER)"
+    query = "CREATE TABLE IF NOT EXISTS messages (tid INTEGER PRIMARY KEY, zid INTEGER, timestamp INTEGER, merged INTEGER DEFAULT 0)"
     db_run_query(query)
-
-def db_add_id(telegram_msg_id: int, zulip_msg_id: int, timestamp: int) -> None:
-    query = "INSERT OR IGNORE INTO messages VALUES (?, ?, ?)"
-    db_run_query(query, telegram_msg_id, zulip_msg_id, timestamp)
+    # Databases created by older versions lack the column marking the messages merged into a single Zulip message
+    with db_lock:
+        columns = [row[1] for row in db_connection.execute("PRAGMA table_info(messages)")]
+    if 'merged' not in columns:
+        db_run_query("ALTER TABLE messages ADD COLUMN merged INTEGER DEFAULT 0")
+
+def db_add_id(telegram_msg_id: int, zulip_msg_id: int, timestamp: int, merged: bool = False) -> None:
+    # The row is only queued: the flusher thread writes the pending rows in batches
+    with db_lock:
+        db_pending[telegram_msg_id] = (zulip_msg_id, timestamp, int(merged))
+        if len(db_pending) >= db_flush_size:
+            db_flush_event.set()
+    db_cache_add(telegram_msg_id, zulip_msg_id, merged)
 
 def db_remove_id(telegram_msg_id: int) -> None:
     query = "DELETE FROM messages WHERE tid=?"
+    with db_lock:
+        db_pending.pop(telegram_msg_id, None)
+        db_cache.pop(telegram_msg_id, None)
     db_run_query(query, telegram_msg_id)
 
-def db_find_id(telegram_msg_id: int) -> int:
-    query = "SELECT zid FROM messages WHERE tid=?"
-    return db_run_query(query, telegram_msg_id, read=True)
+def db_find_id(telegram_msg_id: int) -> Optional[Tuple[int, bool]]:
+    """Return the id of the Zulip message and whether other messages were merged into it, or None if not found"""
+    # Edits only happen within 60 minutes, so recent ids are almost always cached
+    with db_lock:
+        found = db_cache.get(telegram_msg_id)
+        if found is not None:
+            db_cache.move_to_end(telegram_msg_id)
+            return found
+        # A recent message might not have been written to the database yet
+        if telegram_msg_id in db_pending:
+            zulip_msg_id, _, merged = db_pending[telegram_msg_id]
+            return (zulip_msg_id, bool(merged))
+        result = db_connection.execute(db_find_query, (telegram_msg_id,)).fetchone()
+    if result is None:
+        return None
+    db_cache_add(telegram_msg_id, result[0], bool(result[1]))
+    return (result[0], bool(result[1]))
+
+def db_cache_add(telegram_msg_id: int, zulip_msg_id: int, merged: bool = False) -> None:
+    """Store a message id in the LRU cache, evicting the least recently used one if full"""
+    with db_lock:
+        db_cache[telegram_msg_id] = (zulip_msg_id, merged)
+        db_cache.move_to_end(telegram_msg_id)
+        if len(db_cache) > db_cache_size:
+            db_cache.popitem(last=False)
+
+def db_flush() -> None:
+    """Write all the pending message ids to the database in a single transaction"""
+    global db_pending
+    # Hold the lock until the commit, so a lookup never misses a row that is being written
+    with db_lock:
+        if not db_pending:
+            return
+        rows = [(tid, zid, timestamp, merged) for tid, (zid, timestamp, merged) in db_pending.items()]
+        db_pending = {}
+        try:
+            db_connection.execute("BEGIN IMMEDIATE")
+            db_connection.executemany(db_insert_query, rows)
+            db_connection.execute("COMMIT")
+        except Error as e:
+            if db_connection.in_transaction:
+                db_connection.execute("ROLLBACK")
+            log(logging.ERROR, "SQLite3: error %s occurred while writing %d message ids", e, len(rows))
+
+def db_flusher() -> None:
+    """Periodically flush the pending message ids. Runs in a daemon thread"""
+    while True:
+        db_flush_event.wait(db_flush_interval)
+        db_flush_event.clear()
+        db_flush()
     
 
 ##########
@@ -329,31 +572,32 @@ with open(config_file) as config_fp:
     config.read_file(config_fp)
 
 # Local time-zone. Use 'Europe/Zurich'
-local_tz = tz.gettz("Europe/Zurich")
+local_tz = ZoneInfo("Europe/Zurich")
 
 # Date & time formats for printing
 date_fmt = "%d %B %Y"
 time_fmt = "%H:%M"
+datetime_fmt = f"{date_fmt}, {time_fmt}"
 
 # Set up logging
 formatter_str = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 date_format = "%Y-%m-%d"
 date_log_format = "%Y-%m-%d %H:%M"
-log_level = int(config["log"]["log_level"])
+# Read the log settings once: log() is called on every update
+log_conf = config["log"]
+log_level = log_conf.getint("log_level")
+log_to_file = log_conf.getboolean("log_to_file")
 
 # Enable logging
 logging.basicConfig(format=formatter_str, level=log_level, datefmt=date_log_format)
 logger = logging.getLogger(__name__)
 
-# Current timestamp for logging
-date = datetime.datetime.now(tz=local_tz).strftime(date_format)
-
 # Add a file handler to the logger if enabled
 # TODO: all this stuff can be removed as the bot is managed by supervisor which manages logging to disk
-if config["log"].getboolean("log_to_file"):
+if log_to_file:
     # Where to put log files
-    if config["log"]["log_dir"] != '':
-        log_dir = os.path.abspath(config["log"]["log_dir"])
+    if log_conf["log_dir"] != '':
+        log_dir = os.path.abspath(log_conf["log_dir"])
     else:
         log_dir = os.path.abspath(os.path.join(os.getcwd(), "logs"))
     
@@ -361,22 +605,31 @@ if config["log"].getboolean("log_to_file"):
     try:
         os.makedirs(log_dir)
     except (FileExistsError, PermissionError):
-        log(logging.ERROR, f"Directory {log_dir} already exists! Or some 'PermissionError' occurred")
-
-    # Create a file handler for logging
-    logfile_path = os.path.join(log_dir, date + ".log")
-    handler = logging.FileHandler(logfile_path, encoding="utf-8")
+        log(logging.ERROR, "Directory %s already exists! Or some 'PermissionError' occurred", log_dir)
+
+    # Create a file handler for logging, which starts a new file every midnight
+    # Past days are kept with the date as name, YYYY-MM-DD.log
+    logfile_path = os.path.join(log_dir, "bot.log")
+    handler = TimedRotatingFileHandler(logfile_path, when="midnight", encoding="utf-8")
+    handler.suffix = date_format
+    handler.namer = lambda name: os.path.join(log_dir, name.rsplit(".", 1)[-1] + ".log")
     handler.setLevel(log_level)
 
     # Format file handler
     formatter = logging.Formatter(formatter_str)
     handler.setFormatter(formatter)
 
-    # Add file handler to logger
-    logger.addHandler(handler)
+    # Add file handler to logger, through a queue: the file is written by the listener's thread,
+    # so the handlers never wait for the disk
+    log_queue = Queue()
+    logger.addHandler(QueueHandler(log_queue))
+    log_listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop)
 
-    # Redirect all uncaught exceptions to logfile
-    sys.stderr = open(logfile_path, "w")
+    # Log all uncaught exceptions, also those raised in a thread
+    sys.excepthook = lambda exc_type, exc, tb: logger.error("Uncaught exception", exc_info=(exc_type, exc, tb))
+    threading.excepthook = lambda args: logger.error("Uncaught exception in thread %s", args.thread, exc_info=(args.exc_type, args.exc_value, args.exc_traceback))
 
 # Set up Zulip API
 zulip_conf = config["zulip"]
@@ -387,60 +640,134 @@ if '' in (api_key, email):
     exit(msg)
 else:
     zulip_client = zulip.Client(api_key=api_key, email=email, site=site)
+    # The client keeps a single requests.Session: create it now and give it a pool of keep-alive connections,
+    # shared by the dispatcher's workers, so that a TLS handshake is not needed for every forwarded message
+    zulip_client.ensure_session()
+    # Failed connections are retried with a short exponential backoff
+    zulip_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=Retry(total=3, backoff_factor=0.2))
+    zulip_client.session.mount('https://', zulip_adapter)
+    zulip_client.session.mount('http://', zulip_adapter)
+
+# Upload the attached files to Zulip, instead of linking them from Telegram
+upload_files = zulip_conf.getboolean('upload_files', False)
+
+# Requests to Zulip are sent by a pool of workers, so that the dispatcher doesn't wait for the HTTP responses
+# 'zulip_chats' maps a chat to the last request queued for it
+zulip_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="zulip")
+zulip_chats = {}
+zulip_chats_lock = threading.Lock()
+
+# Optionally, during bursts, the new messages of a chat are merged into a single Zulip message
+# 'batch_window' is how long (in seconds) a batch waits for more messages. If 0, every message is sent on its own
+batch_window = zulip_conf.getfloat('batch_window', 0)
+batch_separator = "\n\n---\n\n"
+# Zulip's default maximum length of a message: longer merged messages would be truncated
+batch_max_length = 10000
+# 'zulip_batches' maps a chat to its open batch of messages
+zulip_batches = {}
+# Merged messages: Telegram's message_id -> (Zulip's message id, all the parts of the Zulip message)
+zulip_merged = OrderedDict()
 
 # To be able to send a 'PATCH' API request (i.e., edit a message), we need a mapping between Telegram's message_id and Zulip's
 # We store (telegram_msg_id, zulip_msg_id) in a SQL db
 # 'db_name' can be specified in the [db] section of the config file
+db_path = os.path.abspath(config['db'].get('db_path', 'data.db'))
+# A single connection is opened at startup and reused by every query
+# WAL journaling avoids an fsync per insert and lets reads (on edits) run alongside writes
+db_pragmas = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",
+)
+db_lock = threading.Lock()
+db_connection = db_connect()
 db_create()
 
+# New (telegram_msg_id, zulip_msg_id) pairs are batched: one transaction every 100 ms or every 64 messages
+db_pending = {}
+db_flush_size = 64
+db_flush_interval = 0.1
+db_flush_event = threading.Event()
+threading.Thread(target=db_flusher, name="db_flusher", daemon=True).start()
+# Don't lose the pending ids when the bot stops
+atexit.register(db_flush)
+
+# LRU cache of the most recent (telegram_msg_id, zulip_msg_id) pairs, to avoid a query on every edit
+db_cache = OrderedDict()
+db_cache_size = 4096
+
 # Zulip allows a message to be edited only if it's not older than 60 minutes
-_60min_delta = relativedelta(minutes=60)
+_60min_delta = datetime.timedelta(minutes=60)
 
 # Get stream & topic where to forward the message
-stream = config['zulip']['stream']
-topic = config['zulip']['to']
+stream = zulip_conf['stream']
+topic = zulip_conf['to']
 # If 'topic' empty, the topic will be the current date formatted as dd-MM-YYYY
-date_as_topic = True if not topic else False
-
-# Create the directory where to download files requested to Telegram
-# Downloads dir is by default in $PWD/telegram_downloads
-# TODO: implement something to purge this folder when the bot stops or restarts
-downloads_dir = os.path.join(os.getcwd(), 'telegram_downloads')
-if not os.path.exists(downloads_dir):
-    try:
-        os.makedirs(downloads_dir)
-    except PermissionError:
-        log(logging.WARNING, f"Permission error when attempting to create {downloads_dir}!")
+date_as_topic = not topic
 
 # Check if a Telegram-Zulip username mappings has been supplied
 # This file is required to forward @-mentions to Zulip's stream
 users_mapping = {}
 users_mapping_file = os.path.abspath(zulip_conf.get('zulip_users', 'zulip_users.json'))
 try:
-    with open(users_mapping_file, 'r') as fp:
-        users_mapping = load(fp)
+    with open(users_mapping_file, 'rb') as fp:
+        # Numeric keys are Telegram user ids
+        users_mapping = {int(k) if k.isdigit() else sys.intern(k): v for k, v in json_loads(fp.read()).items()}
 except FileNotFoundError:
-    log(logging.ERROR, f"Users mapping file {users_mapping_file} not found!")
+    log(logging.ERROR, "Users mapping file %s not found!", users_mapping_file)
     raise
 
 # Set up and then run the Telegram bot
+telegram_conf = config["telegram"]
+bot_token = telegram_conf["bot_token"]
+# If a public URL is given, receive the updates with a webhook instead of polling
+webhook_url = telegram_conf.get("webhook_url", "")
+webhook_listen = telegram_conf.get("webhook_listen", "127.0.0.1")
+webhook_port = telegram_conf.getint("webhook_port", 8443)
+# Maximum number of simultaneous HTTPS connections Telegram opens to deliver the updates
+webhook_max_connections = telegram_conf.getint("webhook_max_connections", 40)
+
 # Create the Updater and pass it your bot's token.
-updater = Updater(config["telegram"]['bot_token'])
+# The workers run the asynchronous handlers (commands and replies to unsupported messages)
+updater = Updater(bot_token, workers=8)
 
 # Get the dispatcher to register handlers
 dispatcher = updater.dispatcher
 
 # on different commands - answer in Telegram
-dispatcher.add_handler(CommandHandler("start", start))
-dispatcher.add_handler(CommandHandler("help", help_command))
+dispatcher.add_handler(CommandHandler("start", start, run_async=True))
+dispatcher.add_handler(CommandHandler("help", help_command, run_async=True))
 
 # on non command i.e message - call 'process_message'
-dispatcher.add_handler(MessageHandler(Filters.all & ~Filters.command, process_message))
+# Not run asynchronously: the updates must reach the Zulip pool in the same order as they arrived.
+# The handler is quick anyway, since the requests to Telegram and Zulip are made by the Zulip pool
+dispatcher.add_handler(MessageHandler(supported_content & ~Filters.command, process_message))
+# Other messages (e.g., stickers, polls) can't be forwarded. Service messages (e.g., a user joined the group) are ignored
+dispatcher.add_handler(MessageHandler(~supported_content & ~Filters.command & ~Filters.status_update, unsupported_content, run_async=True))
 
 # Start the Bot
-updater.start_polling()
+# Only new and edited messages are forwarded, so we don't need any other type of update
+allowed_updates = ["message", "edited_message"]
+if webhook_url:
+    # Webhook: Telegram pushes every update to us as soon as it arrives
+    # The bot's token is the (secret) path of the webhook, behind a reverse proxy which terminates HTTPS
+    updater.start_webhook(
+        listen=webhook_listen,
+        port=webhook_port,
+        url_path=bot_token,
+        webhook_url=f"{webhook_url.rstrip('/')}/{bot_token}",
+        allowed_updates=allowed_updates,
+        max_connections=webhook_max_connections)
+else:
+    # Long polling: Telegram holds each getUpdates request open until an update arrives (or the timeout expires)
+    updater.start_polling(poll_interval=0.0, timeout=50, read_latency=2.0, allowed_updates=allowed_updates)
 
 # Run the bot until you press Ctrl-C or the process receives SIGINT,
 # SIGTERM or SIGABRT. This should be used most of the time, since
-# start_polling() is non-blocking and will stop the bot gracefully.
-updater.idle()
\ No newline at end of file
+# start_polling() and start_webhook() are non-blocking and will stop the bot gracefully.
+updater.idle()
+
+# Send the requests still queued before exiting: the Zulip pool can't start new jobs once the interpreter is shutting down
+wait_requests()
\ No newline at end of file